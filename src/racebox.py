@@ -5,11 +5,14 @@
 # comment: 读取RaceBox 数据并存入数据库
 
 import asyncio
+import itertools
 import struct
-from datetime import datetime
+import threading
+import time
 from bleak import BleakScanner, BleakClient
 import json
 import os
+from pathlib import Path
 import configparser
 # import psycopg2
 # import psycopg2.extras as extras
@@ -17,12 +20,25 @@ import uuid
 from loguru import logger
 import taos
 
-import folium
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-from folium.raster_layers import TileLayer
-import math
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson
+    json_dumps, json_loads = orjson.dumps, orjson.loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+    json_loads = json.loads
 
 # 数据库连接定义
 config = configparser.ConfigParser()
@@ -66,7 +82,46 @@ UART_UUID = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
 RX_CHAR_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
 TX_CHAR_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
 NMEA_TX_UUID = "00001103-0000-1000-8000-00805f9b34fb"
-DOWNLOAD_COMMAND = bytes([0xB5, 0x62, 0xFF, 0x23, 0x00, 0x00, 0x22, 0x65])  # Command to initiate data download
+DOWNLOAD_COMMAND = b'\xb5\x62\xff\x23\x00\x00\x22\x65'  # Command to initiate data download
+SYNC_BYTES = b'\xb5\x62'  # 数据包头
+
+# 80字节数据记录结构, 与协议字段顺序一致
+_RECORD_DTYPE = np.dtype([
+    ('itow', '<u4'), ('year', '<u2'), ('month', 'u1'), ('day', 'u1'),
+    ('hour', 'u1'), ('minute', 'u1'), ('second', 'u1'), ('validity_flags', 'u1'),
+    ('time_accuracy', '<u4'), ('nanoseconds', '<i4'), ('fix_status', 'u1'), ('fix_status_flags', 'u1'),
+    ('date_time_flags', 'u1'), ('numberof_svs', 'u1'), ('longitude', '<i4'), ('latitude', '<i4'),
+    ('wgs_altitude', '<i4'), ('msl_altitude', '<i4'), ('horizontal_accuracy', '<u4'), ('vertical_accuracy', '<u4'),
+    ('speed', '<i4'), ('heading', '<i4'), ('speed_accuracy', '<u4'), ('heading_accuracy', '<u4'),
+    ('pdop', '<u2'), ('lat_lon_flags', 'u1'), ('battery_voltage', 'u1'),
+    ('gforce_x', '<i2'), ('gforce_y', '<i2'), ('gforce_z', '<i2'),
+    ('rotation_rate_x', '<i2'), ('rotation_rate_y', '<i2'), ('rotation_rate_z', '<i2'),
+])
+_RECORD_SIZE = _RECORD_DTYPE.itemsize
+assert _RECORD_SIZE == 80
+_FIX_STATUS_OFFSET = _RECORD_DTYPE.fields['fix_status'][1]
+
+# 导入文件名时间格式
+_FILENAME_TS = "{:d}{:02d}{:02d}{:02d}{:02d}{:02d}"
+_FILENAME_FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'second')
+
+# 预编译数据包结构: 包长度、总记录数
+_LEN_STRUCT = struct.Struct('<H')
+_TOTAL_STRUCT = struct.Struct('<I')
+
+# 接收缓冲区已消费字节超过该值时压缩
+BUFFER_COMPACT_SIZE = 65536
+
+# 载荷长度上限, 超出视为误判包头, 避免按错误长度一直等待
+MAX_PACKET_LENGTH = 512
+
+# 是否校验数据包校验和, 关闭后仅依赖蓝牙链路层 CRC, 适用于近距离稳定连接
+VERIFY_CHECKSUM = True
+
+# 未安装 numba 时, 载荷不小于该长度才使用 numpy 校验(实测约 110 字节处更快), 80 字节记录包走累加路径
+# numpy 校验权重按载荷长度缓存
+CHECKSUM_VECTOR_MIN = 128
+_CHECKSUM_WEIGHTS = {}
 
 exists_imp = """select count(1) from imp_racebox where file_name = """
 
@@ -80,12 +135,31 @@ ins_data = """insert into lc_racebox(itow, imp_stamp, year, month, day, hour, mi
 
 ins_taos_sql = """insert into eadm.lc_racebox values"""
 
+exists_taos_imp = """select count(*) from eadm.imp_racebox where file_name = '{}';"""
+
+ins_taos_imp = """insert into eadm.imp_racebox(ts,imp_stamp,file_name,durations) values('now()','{}','{}',{});"""
+
+
+# 同时下载的设备数上限
+MAX_CONCURRENT = 4
+
+# 入库任务串行执行, 查重、导入记录与数据写入不交叉
+DB_SEMAPHORE = asyncio.Semaphore(1)
 
 # 上次连接设备文件
-DEVICE_MEMORY_FILE = "../conf/last_device.json"
+DEVICE_MEMORY_FILE = Path("../conf/last_device.json")
+
+# 上次连接设备进程内缓存, 保存时同步更新
+_last_device_cache = None
+_last_device_loaded = False
 
 # 本次插入数据uuid
 time_uuid = uuid.uuid1()
+time_uuid_str = str(time_uuid)  # TDengine 写入使用的字符串形式
+
+# TDengine 连接, 由 get_taos 延迟建立, 各入库线程共用
+_taos_con = None
+_TAOS_LOCK = threading.Lock()
 
 # 建立数据库连接
 # con = psycopg2.connect(database=pg_database,
@@ -96,12 +170,31 @@ time_uuid = uuid.uuid1()
 #
 # psycopg2.extras.register_uuid()
 
-con_taos = taos.connect(host=td_host,
-                       database=td_database,
-                       port=td_port,
-                       user=td_user,
-                       password=td_password,
-                       timezone=td_timezone)
+
+def get_taos():
+    """首次使用时建立 TDengine 连接, 之后复用"""
+    global _taos_con
+    if _taos_con is None:
+        # 入库线程可能同时首次调用, 加锁保证只建立一个连接
+        with _TAOS_LOCK:
+            if _taos_con is None:
+                _taos_con = taos.connect(host=td_host,
+                                         database=td_database,
+                                         port=td_port,
+                                         user=td_user,
+                                         password=td_password,
+                                         timezone=td_timezone)
+    return _taos_con
+
+
+def close_taos():
+    """关闭已建立的 TDengine 连接"""
+    global _taos_con
+    with _TAOS_LOCK:
+        if _taos_con is not None:
+            _taos_con.close()
+            _taos_con = None
+
 
 def insert_db(in_sql, in_data):
     try:
@@ -137,62 +230,19 @@ def select_db(sel_sql, in_filter):
     finally:
         cur.close()
 
-def load_taos(in_sql, in_data, batch_size):
+def load_taos(in_sql, in_cols, batch_size):
+    """按批写入 TDengine, in_cols 为 decode_records 生成的列数组"""
     try:
-        cur_taos = con_taos.cursor()
-        params = []
-        for i, record in enumerate(in_data, 1):
-            try:
-                microsecond = (record[9] // 1000) % 1_000_000
-                ts = datetime(
-                    year=record[2],
-                    month=record[3],
-                    day=record[4],
-                    hour=record[5],
-                    minute=record[6],
-                    second=record[7],
-                    microsecond=microsecond
-                ).isoformat()
-                params.append((
-                    ts,
-                    record[0],
-                    str(record[1]),
-                    record[2],
-                    record[3],
-                    record[4],
-                    record[5],
-                    record[6],
-                    record[7],
-                    record[8],
-                    record[9],
-                    record[10],
-                    record[11],
-                    record[12],
-                    record[13],
-                    record[14],
-                    record[15],
-                    record[16],
-                    record[17],
-                    record[18],
-                    record[19],
-                    record[20],
-                    record[21],
-                    record[22],
-                    record[23],
-                    record[24],
-                    record[25],
-                    record[26],
-                    record[27],
-                    record[28]
-                ))
-
-                if i % batch_size == 0:
-                    cur_taos.execute_many(in_sql, params)
-                    params = []
-            except ValueError as e:
-                logger.error(f"Invalid datetime parameters in record: {e}")
-                continue
-        if params:
+        cur_taos = get_taos().cursor()
+        imp_stamp = itertools.repeat(time_uuid_str)
+        value_names = [name for name in in_cols if name not in ('ts', 'itow')]
+        for i in range(0, len(in_cols['ts']), batch_size):
+            j = i + batch_size
+            # 列顺序: ts, itow, imp_stamp, 其余字段
+            params = list(zip(np.datetime_as_string(in_cols['ts'][i:j], unit='us').tolist(),
+                              in_cols['itow'][i:j].tolist(),
+                              imp_stamp,
+                              *(in_cols[name][i:j].tolist() for name in value_names)))
             cur_taos.execute_many(in_sql, params)
     except Exception as e:
         logger.error(f"TDengine写入失败: {e}")
@@ -200,44 +250,37 @@ def load_taos(in_sql, in_data, batch_size):
         cur_taos.close()
 
 
-def format_filename(in_first_record, in_last_record):
+def format_filename(in_cols, first, last):
     """生成文件名"""
-    first_year = in_first_record[2]
-    first_month = f"{in_first_record[3]:02d}"
-    first_day = f"{in_first_record[4]:02d}"
-    first_hour = f"{in_first_record[5]:02d}"
-    first_minute = f"{in_first_record[6]:02d}"
-    first_second = f"{in_first_record[7]:02d}"
-    last_year = in_last_record[2]
-    last_month = f"{in_last_record[3]:02d}"
-    last_day = f"{in_last_record[4]:02d}"
-    last_hour = f"{in_last_record[5]:02d}"
-    last_minute = f"{in_last_record[6]:02d}"
-    last_second = f"{in_last_record[7]:02d}"
-    first_timestamp = f"{first_year}{first_month}{first_day}{first_hour}{first_minute}{first_second}"
-    last_timestamp = f"{last_year}{last_month}{last_day}{last_hour}{last_minute}{last_second}"
+    first_timestamp = _FILENAME_TS.format(*(in_cols[name][first] for name in _FILENAME_FIELDS))
+    last_timestamp = _FILENAME_TS.format(*(in_cols[name][last] for name in _FILENAME_FIELDS))
     return f"{first_timestamp}_{last_timestamp}"
 
 
 def save_last_device(device):
     """保存最后一次连接设备信息"""
+    global _last_device_cache, _last_device_loaded
     device_info = {
         "address": device.address,
         "name": device.name
     }
-    with open(DEVICE_MEMORY_FILE, 'w') as f:
-        json.dump(device_info, f)
+    DEVICE_MEMORY_FILE.write_bytes(json_dumps(device_info))
+    _last_device_cache = device_info
+    _last_device_loaded = True
 
 
 def get_last_device():
     """获取最后一次连接成功设备信息"""
+    global _last_device_cache, _last_device_loaded
+    if _last_device_loaded:
+        return _last_device_cache
     try:
-        if os.path.exists(DEVICE_MEMORY_FILE):
-            with open(DEVICE_MEMORY_FILE, 'r') as f:
-                return json.load(f)
+        if DEVICE_MEMORY_FILE.exists():
+            _last_device_cache = json_loads(DEVICE_MEMORY_FILE.read_bytes())
     except Exception as e:
         logger.error(f"设备读取错误: {e}")
-    return None
+    _last_device_loaded = True
+    return _last_device_cache
 
 
 async def scan_device_connect():
@@ -246,15 +289,20 @@ async def scan_device_connect():
 
     if racebox_devices:
         logger.info(f"扫描到 {len(racebox_devices)} 个RaceBox设备")
-        for device in racebox_devices:
-            logger.info(f"连接设备 {device.name} 中...")
-            # 保存连接成功设备
-            save_last_device(device)
-            try:
-                await connect_and_download(device)
-                break  # 仅连接扫描出的第一个设备
-            except Exception as e:
-                logger.info(f"连接设备失败： {device.name}: {e}")
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT)
+
+        async def download(device):
+            async with semaphore:
+                logger.info(f"连接设备 {device.name} 中...")
+                try:
+                    if await connect_and_download(device):
+                        # 保存下载成功设备
+                        save_last_device(device)
+                except Exception as e:
+                    logger.info(f"连接设备失败： {device.name}: {e}")
+
+        # 多台设备并发下载
+        await asyncio.gather(*(download(device) for device in racebox_devices))
 
 
 async def last_device_connect():
@@ -282,170 +330,311 @@ async def last_device_connect():
         raise
 
 
-def parse_message(packet):
-    """处理二进制数据"""
-    payload = packet[6:86]
-    parsed_data = struct.unpack('<I H B B B B B B I i B B B B i i i i I I i i I I H B B h h h h h h', payload[:80])
-    # lng, lat = wgs84_to_gcj02((parsed_data[14] / 1e7), (parsed_data[15] / 1e7))
-    if int(parsed_data[10]) != 0:
-        record = (
-            parsed_data[0],  # "iTOW"
-            time_uuid,  # 导入标签
-            parsed_data[1],  # "Year"
-            parsed_data[2],  # "Month"
-            parsed_data[3],  # "Day"
-            parsed_data[4],  # "Hour"
-            parsed_data[5],  # "Minute"
-            parsed_data[6],  # "Second"
-            parsed_data[8],  # "Time Accuracy"
-            parsed_data[9],  # "Nanoseconds"
-            parsed_data[10],  # "Fix Status"
-            parsed_data[13],  # "Number of SVs"
-            parsed_data[14] / 1e7,  # "Longitude"
-            parsed_data[15] / 1e7,  # "Latitude"
-            parsed_data[16] / 1000,  # "WGS Altitude"
-            parsed_data[17] / 1000,  # "MSL Altitude"
-            parsed_data[18] / 1000,  # "Horizontal Accuracy"
-            parsed_data[19] / 1000,  # "Vertical Accuracy"
-            parsed_data[20] / 100 * 60,  # "Speed"
-            parsed_data[21] / 100000,  # "Heading"
-            parsed_data[22],  # "Speed Accuracy"
-            parsed_data[23] / 1e5,  # "Heading Accuracy"
-            parsed_data[24],  # "PDOP"
-            parsed_data[27] / 1000,  # "G-Force X"
-            parsed_data[28] / 1000,  # "G-Force Y"
-            parsed_data[29] / 1000,  # "G-Force Z"
-            parsed_data[30] / 100,  # "Rotation rate X"
-            parsed_data[31] / 100,  # "Rotation rate Y"
-            parsed_data[32] / 100  # "Rotation rate Z"
-        )
-        return record
-
-
-def validate_checksum(buffer):
+def record_timestamps(arr):
+    """向量化计算记录时间戳(微秒), 返回时间戳及日期有效掩码"""
+    year = arr['year'].astype(np.int64)
+    month = arr['month'].astype(np.int64)
+    day = arr['day'].astype(np.int64)
+    month_start = ((year - 1970) * 12 + month - 1).astype('datetime64[M]').astype('datetime64[D]')
+    days_in_month = ((year - 1970) * 12 + month).astype('datetime64[M]').astype('datetime64[D]') - month_start
+    valid = ((year >= 1) & (year <= 9999) & (month >= 1) & (month <= 12)
+             & (day >= 1) & (day <= days_in_month.astype(np.int64))
+             & (arr['hour'] < 24) & (arr['minute'] < 60) & (arr['second'] < 60))
+    microsecond = (arr['nanoseconds'].astype(np.int64) // 1000) % 1_000_000
+    offset = (((arr['hour'].astype(np.int64) * 60 + arr['minute']) * 60 + arr['second']) * 1_000_000
+              + microsecond)
+    ts = (month_start + (day - 1)).astype('datetime64[us]') + offset.astype('timedelta64[us]')
+    return ts, valid
+
+
+def decode_records(raw):
+    """批量解析会话原始数据, 返回已定位记录及其中日期有效记录的列数组"""
+    fixed = np.frombuffer(raw, dtype=_RECORD_DTYPE)
+    fixed = arr = fixed[fixed['fix_status'] != 0]
+    ts, valid = record_timestamps(arr)
+    if not valid.all():
+        logger.error(f"Invalid datetime parameters in {int((~valid).sum())} records")
+        arr, ts = arr[valid], ts[valid]
+    return fixed, {
+        'ts': ts,  # 时间戳
+        'itow': arr['itow'],  # "iTOW"
+        'year': arr['year'],  # "Year"
+        'month': arr['month'],  # "Month"
+        'day': arr['day'],  # "Day"
+        'hour': arr['hour'],  # "Hour"
+        'minute': arr['minute'],  # "Minute"
+        'second': arr['second'],  # "Second"
+        'time_accuracy': arr['time_accuracy'],  # "Time Accuracy"
+        'nanoseconds': arr['nanoseconds'],  # "Nanoseconds"
+        'fix_status': arr['fix_status'],  # "Fix Status"
+        'numberof_svs': arr['numberof_svs'],  # "Number of SVs"
+        'longitude': arr['longitude'] / 1e7,  # "Longitude"
+        'latitude': arr['latitude'] / 1e7,  # "Latitude"
+        'wgs_altitude': arr['wgs_altitude'] / 1000,  # "WGS Altitude"
+        'msl_altitude': arr['msl_altitude'] / 1000,  # "MSL Altitude"
+        'horizontal_accuracy': arr['horizontal_accuracy'] / 1000,  # "Horizontal Accuracy"
+        'vertical_accuracy': arr['vertical_accuracy'] / 1000,  # "Vertical Accuracy"
+        'speed': arr['speed'] / 100 * 60,  # "Speed"
+        'heading': arr['heading'] / 100000,  # "Heading"
+        'speed_accuracy': arr['speed_accuracy'],  # "Speed Accuracy"
+        'heading_accuracy': arr['heading_accuracy'] / 1e5,  # "Heading Accuracy"
+        'pdop': arr['pdop'],  # "PDOP"
+        'gforce_x': arr['gforce_x'] / 1000,  # "G-Force X"
+        'gforce_y': arr['gforce_y'] / 1000,  # "G-Force Y"
+        'gforce_z': arr['gforce_z'] / 1000,  # "G-Force Z"
+        'rotation_rate_x': arr['rotation_rate_x'] / 100,  # "Rotation rate X"
+        'rotation_rate_y': arr['rotation_rate_y'] / 100,  # "Rotation rate Y"
+        'rotation_rate_z': arr['rotation_rate_z'] / 100  # "Rotation rate Z"
+    }
+
+
+def _checksum_weights(size):
+    """获取指定载荷长度的校验权重"""
+    weights = _CHECKSUM_WEIGHTS.get(size)
+    if weights is None:
+        weights = np.arange(size, 0, -1, dtype=np.uint32)
+        _CHECKSUM_WEIGHTS[size] = weights
+    return weights
+
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False, nogil=True)
+    def _fletcher8(data):
+        """校验和本地编译内核, 返回 ck_b << 8 | ck_a"""
+        ck_a = 0
+        ck_b = 0
+        for i in range(data.shape[0]):
+            ck_a = (ck_a + int(data[i])) & 0xFF
+            ck_b = (ck_b + ck_a) & 0xFF
+        return (ck_b << 8) | ck_a
+else:
+    _fletcher8 = None
+
+
+def validate_checksum(buffer, offset=0, length=None):
     """根据结构协议校验数据"""
-    ck_a, ck_b = 0, 0
-    for byte in buffer[2:-2]:
-        ck_a = (ck_a + byte) & 0xFF
-        ck_b = (ck_b + ck_a) & 0xFF
-    return ck_a == buffer[-2] and ck_b == buffer[-1]
+    if length is None:
+        length = len(buffer) - offset
+    end = offset + length
+    size = length - 4
+    if _fletcher8 is not None:
+        packed = _fletcher8(np.frombuffer(buffer, dtype=np.uint8, count=size, offset=offset + 2))
+        ck_a, ck_b = packed & 0xFF, packed >> 8
+    elif size < CHECKSUM_VECTOR_MIN:
+        # 短包直接在 C 层累加: ck_b 为各前缀和之和
+        data = buffer[offset + 2:end - 2]
+        ck_a = sum(data) & 0xFF
+        ck_b = sum(itertools.accumulate(data)) & 0xFF
+    else:
+        data = np.frombuffer(buffer, dtype=np.uint8, count=size, offset=offset + 2)
+        # ck_a = Σa[i], ck_b = Σ(n-i)·a[i], uint32 溢出不影响低8位
+        ck_a = int(data.sum(dtype=np.uint32)) & 0xFF
+        ck_b = int(np.dot(_checksum_weights(size), data)) & 0xFF
+    return ck_a == buffer[end - 2] and ck_b == buffer[end - 1]
+
+
+class DownloadContext:
+    """单台设备下载过程状态"""
+    __slots__ = ("session_raw", "total_records", "session_num", "down_start_time", "session_start_time",
+                 "download_complete", "pending")
+
+    def __init__(self):
+        self.session_raw = bytearray()
+        self.total_records = 0
+        self.session_num = 0
+        self.down_start_time = time.perf_counter()
+        self.session_start_time = time.perf_counter()
+        self.download_complete = asyncio.Event()
+        self.pending = set()  # 未完成的入库任务
+
+
+def handle_total(ctx, buffer, pos, packet_length):
+    """开始下载, 读取总记录数"""
+    if packet_length < _TOTAL_STRUCT.size:
+        return
+    ctx.total_records = _TOTAL_STRUCT.unpack_from(buffer, pos + 6)[0]
+    logger.info(f"总计 {ctx.total_records} 条记录")
+
+
+def handle_record(ctx, buffer, pos, packet_length):
+    """历史数据 / 实时数据, 暂存原始载荷"""
+    if packet_length >= _RECORD_SIZE:
+        ctx.session_raw.extend(buffer[pos + 6:pos + 6 + _RECORD_SIZE])
+
+
+def handle_complete(ctx, buffer, pos, packet_length):
+    """下载完成"""
+    # logger.info(
+    #     f"下载完成，耗时 {time.perf_counter() - ctx.down_start_time} 秒！")
+    ctx.download_complete.set()
+
+
+def handle_session_end(ctx, buffer, pos, packet_length):
+    """一段记录结束, 交由后台线程解析入库"""
+    # 本段无定位记录时不计段数, 与逐条解析时一致
+    if not any(ctx.session_raw[_FIX_STATUS_OFFSET::_RECORD_SIZE]):
+        ctx.session_raw.clear()
+        return
+    ctx.session_num += 1
+    duration = time.perf_counter() - ctx.session_start_time
+    raw, ctx.session_raw = ctx.session_raw, bytearray()
+    task = asyncio.create_task(persist_session_async(raw, ctx.session_num, duration))
+    ctx.pending.add(task)
+    task.add_done_callback(ctx.pending.discard)
+    ctx.session_start_time = time.perf_counter()
+
+
+async def persist_session_async(raw, session_num, duration):
+    """在线程中入库, 不阻塞蓝牙数据接收"""
+    async with DB_SEMAPHORE:
+        try:
+            await asyncio.to_thread(persist_session, raw, session_num, duration)
+        except Exception as e:
+            logger.error(f"第{session_num}段数据处理失败: {e}")
+
+
+def persist_session(raw, session_num, duration):
+    """解析一段原始数据并写入数据库"""
+    # 会话结束时批量解析本段原始数据
+    fixed, session_data = decode_records(raw)
+    # 文件名取本段首末定位记录, 与日期是否有效无关
+    file_name = format_filename(fixed, 0, len(fixed) - 1)
+    session_len = len(session_data['ts'])
+    if not session_len:
+        logger.info(f"第{session_num}段数据文件名：{file_name}，{len(fixed)}条定位记录日期均无效，已跳过！")
+        return
+
+    # pg
+    # exists_data = select_db(exists_imp, file_name)
+    # if exists_data == 0:
+    #     if session_len > 0:
+    #         imp_data = (time_uuid, file_name, duration)
+    #         insert_db(ins_imp, imp_data)
+    #         load_db(ins_data, session_data)
+    #         logger.info(f"已处理第{session_num}段数据文件名：{file_name}，共计{session_len}条，耗时 {duration} 秒！")
+    #     else:
+    #         logger.info(f"第{session_num}段数据文件名：{file_name}，共计{session_len}条，处理耗时 {duration} 秒，无数据，已跳过！")
+    # else:
+    #     logger.info(f"第{session_num}段数据文件名：{file_name}，共计{session_len}条，处理耗时 {duration} 秒，数据库中已存在，已跳过！")
+
+    # taos    
+    try:
+        con_taos = get_taos()
+        taos_exists = con_taos.query(exists_taos_imp.format(file_name)).fetch_all()
+        if taos_exists[0][0] == 0:
+            con_taos.execute(ins_taos_imp.format(time_uuid_str, file_name, duration))
+            load_taos(ins_taos_sql, session_data, 1000)
+            logger.info(f"已处理第{session_num}段数据文件名：{file_name}，共计{session_len}条，耗时 {duration} 秒！")
+        else:
+            logger.info(f"第{session_num}段数据文件名：{file_name}，共计{session_len}条，处理耗时 {duration} 秒，数据库中已存在，已跳过！")
+    except Exception as e:
+        logger.error(f"TDengine写入失败: {e}")
+
+
+# 消息 ID 分发表
+MESSAGE_HANDLERS = {
+    0x23: handle_total,
+    0x21: handle_record,
+    0x01: handle_record,
+    0x02: handle_complete,
+    0x26: handle_session_end,
+}
 
 
 async def connect_and_download(device):
-    """建立已扫描连接并下载数据"""
-    session_data = []
+    """建立已扫描连接并下载数据, 下载完成返回 True"""
+    ctx = DownloadContext()
     buffer = bytearray()
-    total_records = 0
-    download_complete = asyncio.Event()
-    session_num = 0
-    down_start_time = datetime.now()
-    session_start_time = datetime.now()
-    first_record = None
-    last_record = None
+    pos = 0
+    loop = asyncio.get_running_loop()
+    packet_queue = asyncio.Queue()
+    drain_task = None
 
     async with (BleakClient(device.address, timeout=20) as client):
         try:
-            await client.disconnect()
-            await client.connect()
+            service_uuids = {str(service.uuid) for service in client.services}
 
-            services = client.services
-
-            if UART_UUID not in [str(service.uuid) for service in services]:
+            if UART_UUID not in service_uuids:
                 logger.error(f"设备 {device.name} 无 UART 服务！")
-                return
+                return False
 
             def notification_handler(sender, data):
-                nonlocal buffer, session_data, total_records, session_num, down_start_time, session_start_time, first_record, last_record
+                # 回调中仅入队, 解析由 drain_packets 完成, 避免阻塞蓝牙通知分发
+                loop.call_soon_threadsafe(packet_queue.put_nowait, bytes(data))
+
+            def process_data(data):
+                nonlocal pos
                 buffer.extend(data)
 
-                # 处理传输数据
-                while len(buffer) >= 8:
-                    if buffer[:2] == bytes([0xB5, 0x62]):
-                        message_class, message_id = buffer[2], buffer[3]
-                        packet_length = struct.unpack('<H', buffer[4:6])[0]
+                # 处理传输数据, pos 为已消费位置
+                while len(buffer) - pos >= 8:
+                    if buffer.startswith(SYNC_BYTES, pos):
+                        message_class, message_id = buffer[pos + 2], buffer[pos + 3]
+                        packet_length = _LEN_STRUCT.unpack_from(buffer, pos + 4)[0]
+                        if packet_length > MAX_PACKET_LENGTH:
+                            pos += 1
+                            continue
                         full_packet_length = packet_length + 8
 
-                        if len(buffer) < full_packet_length:
+                        if len(buffer) - pos < full_packet_length:
                             break
 
-                        if validate_checksum(buffer[:full_packet_length]):
+                        # 先移动读位置, 处理函数出错时不会反复卡在同一数据包
+                        start = pos
+                        pos += full_packet_length
+                        if not VERIFY_CHECKSUM or validate_checksum(buffer, start, full_packet_length):
                             if message_class == 0xFF:
-                                if message_id == 0x23:  # 开始下载
-                                    total_records = struct.unpack('<I', buffer[6:10])[0]
-                                    logger.info(f"总计 {total_records} 条记录")
-                                elif message_id == 0x21:  # 历史数据
-                                    record = parse_message(buffer[:full_packet_length])
-                                    if record:
-                                        session_data.append(record)
-                                        if first_record is None:
-                                            first_record = record
-                                        last_record = record
-                                elif message_id == 0x01:  # 实时数据
-                                    record = parse_message(buffer[:full_packet_length])
-                                    if record:
-                                        session_data.append(record)
-                                        if first_record is None:
-                                            first_record = record
-                                    last_record = record
-                                elif message_id == 0x02:
-                                    # logger.info(
-                                    #     f"下载完成，耗时 {(datetime.now() - down_start_time).total_seconds()} 秒！")
-                                    download_complete.set()
-                                elif message_id == 0x26:
-                                    if first_record:
-                                        session_num += 1
-                                        duration = (datetime.now() - session_start_time).total_seconds()
-                                        file_name = format_filename(first_record, last_record)
-                                        session_len = len(session_data)
-                                        
-                                        # pg
-                                        # exists_data = select_db(exists_imp, file_name)
-                                        # if exists_data == 0:
-                                        #     if session_len > 0:
-                                        #         imp_data = (time_uuid, file_name, duration)
-                                        #         insert_db(ins_imp, imp_data)
-                                        #         load_db(ins_data, session_data)
-                                        #         logger.info(f"已处理第{session_num}段数据文件名：{file_name}，共计{session_len}条，耗时 {duration} 秒！")
-                                        #     else:
-                                        #         logger.info(f"第{session_num}段数据文件名：{file_name}，共计{session_len}条，处理耗时 {duration} 秒，无数据，已跳过！")
-                                        # else:
-                                        #     logger.info(f"第{session_num}段数据文件名：{file_name}，共计{session_len}条，处理耗时 {duration} 秒，数据库中已存在，已跳过！")
-                                        
-                                        # taos    
-                                        try:
-                                            taos_exists_sql = f'select count(*) from eadm.imp_racebox where file_name = \'{file_name}\';'
-                                            taos_exists = con_taos.query(taos_exists_sql).fetch_all()
-                                            if taos_exists[0][0] == 0:
-                                                if session_len > 0:
-                                                    ins_taos_imp = (f'insert into eadm.imp_racebox(ts,imp_stamp,file_name,durations) '
-                                                                    f'values(\'now()\',\'{time_uuid}\',\'{file_name}\',{duration});')
-                                                    con_taos.execute(ins_taos_imp)
-                                                    load_taos(ins_taos_sql, session_data, 1000)
-                                                    logger.info(f"已处理第{session_num}段数据文件名：{file_name}，共计{session_len}条，耗时 {duration} 秒！")
-                                                else:
-                                                    logger.info(f"第{session_num}段数据文件名：{file_name}，共计{session_len}条，处理耗时 {duration} 秒，无数据，已跳过！")
-                                            else:
-                                                logger.info(f"第{session_num}段数据文件名：{file_name}，共计{session_len}条，处理耗时 {duration} 秒，数据库中已存在，已跳过！")
-                                        except Exception as e:
-                                            logger.error(f"TDengine写入失败: {e}")
-
-                                        session_start_time = datetime.now()
-                                        first_record = None
-                                        session_data = []
-                            buffer = buffer[full_packet_length:]
-
+                                handler = MESSAGE_HANDLERS.get(message_id)
+                                if handler is not None:
+                                    handler(ctx, buffer, start, packet_length)
+                    else:
+                        # 非包头, 逐字节重新同步
+                        pos += 1
+
+                # 已消费数据全部处理完或积累过多时压缩缓冲区
+                if pos >= len(buffer):
+                    buffer.clear()
+                    pos = 0
+                elif pos > BUFFER_COMPACT_SIZE:
+                    del buffer[:pos]
+                    pos = 0
+
+            async def drain_packets():
+                while True:
+                    data = await packet_queue.get()
+                    try:
+                        process_data(data)
+                    except Exception as e:
+                        logger.error(f"数据解析失败: {e}")
+
+            drain_task = asyncio.create_task(drain_packets())
             await client.start_notify(TX_CHAR_UUID, notification_handler)
             await client.write_gatt_char(RX_CHAR_UUID, DOWNLOAD_COMMAND)
             logger.info(f"正在从设备 {device.name} 下载数据...")
 
             # 等待下载完成
-            await download_complete.wait()
+            await ctx.download_complete.wait()
             await client.stop_notify(TX_CHAR_UUID)
+            return True
         except Exception as e:
             logger.error(e)
+            return False
         finally:
+            if drain_task is not None:
+                drain_task.cancel()
             await client.disconnect()
+            # 等待已提交的入库任务完成
+            if ctx.pending:
+                await asyncio.gather(*ctx.pending)
+
 
-start_time = datetime.now()
-asyncio.run(last_device_connect())
-logger.info(f"所有操作完成，总计耗时 {(datetime.now() - start_time).total_seconds()} 秒！")
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+    try:
+        if uvloop is not None:
+            uvloop.run(last_device_connect())
+        else:
+            asyncio.run(last_device_connect())
+    finally:
+        close_taos()
+    logger.info(f"所有操作完成，总计耗时 {time.perf_counter() - start_time} 秒！")